@@ -1,16 +1,23 @@
 import asyncio
+import functools
 import os
 import logging
 import hashlib
 import re
-from html import unescape
-from datetime import datetime, timedelta
+import signal
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from html import escape as _html_escape, unescape
+from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 import aiohttp
 import aiosqlite
 import feedparser
+import orjson
 import yaml
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -25,7 +32,8 @@ SOURCES_FILE = os.getenv("SOURCES_FILE", "/app/sources.yaml")
 # scheduling & throttling (more frequent defaults)
 CHECK_INTERVAL_MINUTES = int(os.getenv("CHECK_INTERVAL_MINUTES", "30"))  # every 30 minutes
 MAX_POSTS_PER_RUN = int(os.getenv("MAX_POSTS_PER_RUN", "3"))             # per run hard cap
-MIN_DELAY_BETWEEN_POSTS = float(os.getenv("MIN_DELAY_BETWEEN_POSTS", "2"))  # seconds
+TELEGRAM_MAX_PER_MINUTE = int(os.getenv("TELEGRAM_MAX_PER_MINUTE", "20"))  # telegram's per-chat limit
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "8"))               # feeds fetched in parallel
 
 # "smart" limits
 DAILY_MAX_POSTS = int(os.getenv("DAILY_MAX_POSTS", "30"))  # desired posts per rolling 24h
@@ -38,32 +46,50 @@ NIGHT_END_HOUR = int(os.getenv("NIGHT_END_HOUR", "7"))
 
 USER_AGENT = os.getenv("USER_AGENT", "it-ambient-aggregator/1.0 (+https://example.com)")
 TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+JSON_HEADERS = {"Content-Type": "application/json"}
+# fail fast on connect/TLS, but leave room for slow body reads
+TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5, sock_read=15)
+
+# shared HTTP session (feeds + telegram), created in start_loop
+SESSION: aiohttp.ClientSession = None
+# dedicated pool for feedparser so parsing doesn't compete with other to_thread work
+FEED_POOL = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="feedparse")
+# telegram sends (retries included) are spaced evenly: one token per 60/N seconds, no burst
+TG_LIMITER = AsyncLimiter(1, 60 / TELEGRAM_MAX_PER_MINUTE)
+# shared sqlite connection, opened in init_db; writes are serialized by DB_WRITE_LOCK
+DB: aiosqlite.Connection = None
+DB_WRITE_LOCK = asyncio.Lock()
+# LRU of url hashes known to be sent, checked before hitting sent_items
+RECENT_HASHES_MAX = 10000
+_RECENT_HASHES: "OrderedDict[bytes, None]" = OrderedDict()
+# last good response per feed url: (etag, last_modified, items), replayed on 304
+_FEED_CACHE: dict = {}
 
 # ---------------- Logging ----------------
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
 # ---------------- helpers ----------------
+_TAG_RE = re.compile(r"<[^>]+>")
+_NUM_COMMENTS_RE = re.compile(r"\b\d+\s+comments?\b", re.I)
+_COMMENTS_RE = re.compile(r"\bcomments?\b", re.I)
+_WS_RE = re.compile(r"\s+")
+
 def clean_text(text: str) -> str:
     """Remove HTML tags, comment counters and collapse whitespace."""
     if not text:
         return ""
-    text = unescape(text)
     # remove tags
-    text = re.sub(r"<[^>]+>", "", text)
+    text = _TAG_RE.sub("", unescape(text))
     # remove comment counters etc
-    text = re.sub(r"\b\d+\s+comments?\b", "", text, flags=re.I)
-    text = re.sub(r"\bcomments?\b", "", text, flags=re.I)
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    text = _NUM_COMMENTS_RE.sub("", text)
+    text = _COMMENTS_RE.sub("", text)
+    return _WS_RE.sub(" ", text).strip()
 
 def escape_html_text(s: str) -> str:
-    if not s:
-        return ""
-    s = s.replace("&", "&amp;")
-    s = s.replace("<", "&lt;")
-    s = s.replace(">", "&gt;")
-    return s
+    # escapes &, < and > only, same as before
+    return _html_escape(s, quote=False) if s else ""
 
+@functools.lru_cache(maxsize=4096)
 def domain_from_url(url: str) -> str:
     try:
         p = urlparse(url)
@@ -71,61 +97,110 @@ def domain_from_url(url: str) -> str:
     except Exception:
         return ""
 
-def norm_hash(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+@functools.lru_cache(maxsize=4096)
+def norm_hash(s: str) -> bytes:
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).digest()
 
-def now_utc() -> datetime:
-    return datetime.utcnow()
+DAY_SECONDS = 24 * 60 * 60
+
+def now_epoch() -> int:
+    return int(time.time())
+
+def iso_to_epoch(ts) -> int:
+    """Convert a legacy naive-UTC ISO timestamp to unix epoch seconds."""
+    if isinstance(ts, (int, float)):
+        return int(ts)
+    try:
+        return int(datetime.fromisoformat(ts).replace(tzinfo=timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        return 0
 
 # ---------------- DB ----------------
+SENT_ITEMS_DDL = """
+    CREATE TABLE IF NOT EXISTS sent_items (
+        url_hash BLOB PRIMARY KEY,
+        url TEXT,
+        domain TEXT,
+        title TEXT,
+        ts INTEGER
+    )
+"""
+
+async def migrate_sent_items():
+    """Rebuild sent_items created by older versions (hex TEXT url_hash, ISO TEXT ts)."""
+    async with DB.execute("PRAGMA table_info(sent_items)") as cur:
+        cols = {r[1]: (r[2] or "").upper() for r in await cur.fetchall()}
+    if cols.get("url_hash") == "BLOB" and cols.get("ts") == "INTEGER":
+        return
+    async with DB.execute("SELECT url, domain, title, ts FROM sent_items") as cur:
+        rows = await cur.fetchall()
+    logging.info("Migrating sent_items to the current schema (%s rows)", len(rows))
+    await DB.execute("DROP TABLE sent_items")
+    await DB.execute(SENT_ITEMS_DDL)
+    await DB.executemany("INSERT OR IGNORE INTO sent_items(url_hash, url, domain, title, ts) VALUES(?,?,?,?,?)",
+                         [(norm_hash(url), url, domain, title, iso_to_epoch(ts))
+                          for url, domain, title, ts in rows if url])
+
 async def init_db():
+    global DB
     # ensure directory exists for DB_PATH
     db_dir = os.path.dirname(DB_PATH)
     if db_dir and not os.path.exists(db_dir):
         os.makedirs(db_dir, exist_ok=True)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS sent_items (
-                url_hash TEXT PRIMARY KEY,
-                url TEXT,
-                domain TEXT,
-                title TEXT,
-                ts TEXT
-            )
-        """)
-        await db.commit()
+    DB = await aiosqlite.connect(DB_PATH)
+    await DB.execute("PRAGMA journal_mode=WAL")
+    await DB.execute("PRAGMA synchronous=NORMAL")
+    await DB.execute("PRAGMA temp_store=MEMORY")
+    async with DB_WRITE_LOCK:
+        # schema setup and migration in one transaction
+        await DB.execute("BEGIN IMMEDIATE")
+        await DB.execute(SENT_ITEMS_DDL)
+        await migrate_sent_items()
+        await DB.execute("CREATE INDEX IF NOT EXISTS idx_sent_ts ON sent_items(ts)")
+        await DB.execute("CREATE INDEX IF NOT EXISTS idx_sent_domain_ts ON sent_items(domain, ts)")
+        await DB.commit()
     logging.info("DB initialized (%s)", DB_PATH)
 
-async def already_sent(url: str) -> bool:
-    h = norm_hash(url)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM sent_items WHERE url_hash = ?", (h,))
-        r = await cur.fetchone()
-        return r is not None
-
-async def mark_sent(url: str, title: str = ""):
-    h = norm_hash(url)
-    domain = domain_from_url(url)
-    ts = now_utc().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO sent_items(url_hash, url, domain, title, ts) VALUES(?,?,?,?,?)",
-                         (h, url, domain, title, ts))
-        await db.commit()
-async def count_sent_last_24h() -> int:
-    cutoff = (now_utc() - timedelta(hours=24)).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM sent_items WHERE ts >= ?", (cutoff,))
-        r = await cur.fetchone()
-        return (r[0] if r and r[0] is not None else 0)
+def sent_row(url: str, title: str = "") -> tuple:
+    return (norm_hash(url), url, domain_from_url(url), title, now_epoch())
 
-async def count_sent_by_domain_last_24h(domain: str) -> int:
-    if not domain:
-        return 0
-    cutoff = (now_utc() - timedelta(hours=24)).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM sent_items WHERE domain = ? AND ts >= ?", (domain, cutoff))
+async def mark_sent_many(rows: list):
+    """Insert buffered sent rows in a single transaction (one commit per batch)."""
+    if not rows:
+        return
+    async with DB_WRITE_LOCK:
+        await DB.executemany("INSERT OR IGNORE INTO sent_items(url_hash, url, domain, title, ts) VALUES(?,?,?,?,?)",
+                             rows)
+        await DB.commit()
+
+def _seen(h: bytes) -> bool:
+    if h in _RECENT_HASHES:
+        _RECENT_HASHES.move_to_end(h)
+        return True
+    return False
+
+def _remember(h: bytes):
+    _RECENT_HASHES[h] = None
+    _RECENT_HASHES.move_to_end(h)
+    while len(_RECENT_HASHES) > RECENT_HASHES_MAX:
+        _RECENT_HASHES.popitem(last=False)
+
+async def already_sent(h: bytes) -> bool:
+    if _seen(h):
+        return True
+    async with DB.execute("SELECT 1 FROM sent_items WHERE url_hash = ?", (h,)) as cur:
         r = await cur.fetchone()
-        return (r[0] if r and r[0] is not None else 0)
+    if r is not None:
+        _remember(h)
+        return True
+    return False
+
+async def load_recent_state():
+    """Per-run snapshot: (per-domain counts for last 24h, total for last 24h)."""
+    cutoff = now_epoch() - DAY_SECONDS
+    async with DB.execute("SELECT domain FROM sent_items WHERE ts >= ?", (cutoff,)) as cur:
+        domains = Counter(r[0] or "" for r in await cur.fetchall())
+    return domains, sum(domains.values())
 
 # ---------------- sources loader ----------------
 def load_sources_from_yaml(path: str):
@@ -145,9 +220,31 @@ def load_sources_from_yaml(path: str):
     return out
 
 # ---------------- fetching ----------------
-async def fetch_feed_entries(url: str):
-    loop = asyncio.get_event_loop()
-    parsed = await loop.run_in_executor(None, feedparser.parse, url)
+async def fetch_feed_entries(url: str, sem: asyncio.Semaphore):
+    """Fetch feed entries; conditional GET when a cached copy exists, 304 returns the cached items."""
+    cached = _FEED_CACHE.get(url)
+    headers = {}
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    async with sem:
+        async with SESSION.get(url, headers=headers, timeout=TIMEOUT) as resp:
+            if resp.status == 304 and cached:
+                logging.info("Feed not modified: %s", url)
+                return cached[2]
+            resp.raise_for_status()
+            data = await resp.read()
+            validators = (resp.headers.get("ETag"), resp.headers.get("Last-Modified"))
+            response_headers = {
+                "content-type": resp.headers.get("Content-Type", ""),
+                "content-location": str(resp.url),
+            }
+    loop = asyncio.get_running_loop()
+    parsed = await loop.run_in_executor(FEED_POOL, functools.partial(feedparser.parse, data,
+                                                                     response_headers=response_headers))
     items = []
     for e in parsed.entries:
         link = e.get("link") or e.get("id")
@@ -159,27 +256,38 @@ async def fetch_feed_entries(url: str):
             "url": link,
             "published": e.get("published", "")
         })
+    if any(validators):
+        _FEED_CACHE[url] = (*validators, items)
+    else:
+        _FEED_CACHE.pop(url, None)
     return items
 
 # ---------------- telegram send w/ 429 ----------------
+def retry_after_from(header: str, body: str) -> int:
+    """Seconds to wait after a 429: Retry-After header, else parameters.retry_after from the body."""
+    try:
+        return int(header)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(orjson.loads(body).get("parameters", {}).get("retry_after", 30))
+    except Exception:
+        return 30
+
 async def send_message_telegram(payload: dict):
-    async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}) as sess:
-        try:
-            async with sess.post(TELEGRAM_API, json=payload, timeout=30) as resp:
-                text = await resp.text()
-                if resp.status == 200:
-                    return True, None
-                elif resp.status == 429:
-                    try:
-                        js = await resp.json()
-                        retry_after = int(js.get("parameters", {}).get("retry_after", 30))
-                    except Exception:
-                        retry_after = 30
-                    return False, ("rate_limit", retry_after)
-                else:
-                    return False, ("error", f"{resp.status} {text[:400]}")
-        except Exception as e:
-            return False, ("exception", str(e))
+    try:
+        body = orjson.dumps(payload)
+        async with TG_LIMITER, SESSION.post(TELEGRAM_API, data=body, headers=JSON_HEADERS, timeout=TIMEOUT) as resp:
+            text = await resp.text()
+            if resp.status == 200:
+                return True, None
+            elif resp.status == 429:
+                retry_after = retry_after_from(resp.headers.get("Retry-After"), text)
+                return False, ("rate_limit", retry_after)
+            else:
+                return False, ("error", f"{resp.status} {text[:400]}")
+    except Exception as e:
+        return False, ("exception", str(e))
 
 async def safe_send_html(text: str):
     payload = {
@@ -206,8 +314,7 @@ async def safe_send_html(text: str):
 
 # ---------------- Night mode helper ----------------
 def in_night_mode() -> bool:
-    now = datetime.now()
-    h = now.hour
+    h = time.localtime().tm_hour
     start = NIGHT_START_HOUR
     end = NIGHT_END_HOUR
     if start < end:
@@ -217,15 +324,46 @@ def in_night_mode() -> bool:
         return (h >= start or h < end)
 
 # ---------------- Core processing ----------------
-async def process_source(src: dict, posts_left: int):
-    sent = 0
+async def fetch_stage(src: dict, sem: asyncio.Semaphore):
     try:
-        entries = await fetch_feed_entries(src["url"])
+        return await fetch_feed_entries(src["url"], sem)
     except Exception as e:
         logging.warning("Failed to fetch feed %s: %s", src["url"], e)
-        return 0
+        return []
+
+def format_message(src: dict, e: dict, url: str):
+    """Build the Telegram HTML message for an entry; returns (clean title, message)."""
+    title = clean_text(e.get("title", "")) or url
+    summary = clean_text(e.get("summary", ""))
+
+    if summary and summary.lower() in title.lower():
+        summary = ""
+
+    if len(summary) > 300:
+        summary = summary[:297] + "..."
+
+    tag = src.get("tag") or "IT"
+
+    title_html = escape_html_text(title)
+    summary_html = escape_html_text(summary)
+    tag_html = escape_html_text(tag)
+
+    msg = f"<b>[{tag_html}] {title_html}</b>"
+    if summary_html:
+        msg += f"\n\n{summary_html}"
+    msg += f'\n\n<a href="{escape_html_text(url)}">source</a>'
+    return title, msg
+
+async def post_stage(src: dict, entries: list, posts_left: int, domain_counts: Counter, pending_inserts: list):
+    """Post entries of one feed; returns (sent, send_failed), posting stops at the first failed send."""
+    sent = 0
+    # night mode: don't post (checked once per feed, not per entry)
+    if in_night_mode():
+        logging.info("Night mode active — skipping posting for now")
+        return sent, False
 
     for e in entries:
+        # posts_left already includes the daily limit, so this is the only budget check
         if posts_left <= 0:
             break
 
@@ -233,63 +371,32 @@ async def process_source(src: dict, posts_left: int):
         if not url:
             continue
 
-        # night mode: don't post
-        if in_night_mode():
-            logging.info("Night mode active — skipping posting for now")
-            break
-
-        # global daily limit
-        sent_last24 = await count_sent_last_24h()
-        remaining_today = max(0, DAILY_MAX_POSTS - sent_last24)
-        if remaining_today <= 0:
-            logging.info("Daily limit reached (%s posts in last 24h). Stopping for this run.", sent_last24)
-            break
-
-        # effective allowed this iteration
-        effective_allowed = min(posts_left, remaining_today, MAX_POSTS_PER_RUN)
-        if effective_allowed <= 0:
-            break
-
-        if await already_sent(url):
+        # cheapest and most selective filter first: most entries were posted on earlier runs
+        h = norm_hash(url)
+        if await already_sent(h):
             continue
 
         domain = domain_from_url(url)
-        domain_count = await count_sent_by_domain_last_24h(domain)
+        domain_count = domain_counts[domain] if domain else 0
         if domain_count >= DOMAIN_MAX_PER_24H:
             logging.info("Skipping %s because domain %s already posted %s times in 24h", url, domain, domain_count)
             continue
 
-        title = clean_text(e.get("title", "")) or url
-        summary = clean_text(e.get("summary", ""))
-
-        if summary and summary.lower() in title.lower():
-            summary = ""
-
-        if len(summary) > 300:
-            summary = summary[:297] + "..."
-
-        tag = src.get("tag") or "IT"
-
-        title_html = escape_html_text(title)
-        summary_html = escape_html_text(summary)
-        tag_html = escape_html_text(tag)
-
-        msg = f"<b>[{tag_html}] {title_html}</b>"
-        if summary_html:
-            msg += f"\n\n{summary_html}"
-        msg += f'\n\n<a href="{escape_html_text(url)}">source</a>'
-
+        # all gates passed; only now pay for cleaning and escaping
+        title, msg = format_message(src, e, url)
         ok = await safe_send_html(msg)
         if ok:
-            # mark after successful send
-            await mark_sent(url, title)
+            # mark after successful send; flushed to DB at the end of the run
+            pending_inserts.append(sent_row(url, title))
+            _remember(h)
+            domain_counts[domain] += 1
             sent += 1
             posts_left -= 1
-            await asyncio.sleep(MIN_DELAY_BETWEEN_POSTS)
         else:
-            await asyncio.sleep(5)
+            # telegram is failing (429 already retried in safe_send_html); leave the rest for the next run
+            return sent, True
 
-    return sent
+    return sent, False
 
 async def main_job():
     logging.info("Job started")
@@ -302,40 +409,66 @@ async def main_job():
         logging.info("Night mode active — skipping job run")
         return
 
-    sent_last24 = await count_sent_last_24h()
+    domain_counts, sent_last24 = await load_recent_state()
     remaining_today = max(0, DAILY_MAX_POSTS - sent_last24)
     if remaining_today <= 0:
         logging.info("Daily target already reached (%s posts in last 24h). Skipping run.", sent_last24)
         return
 
+    # run budget from the snapshot; post_stage stops as soon as it is spent
     posts_remaining = min(MAX_POSTS_PER_RUN, remaining_today)
 
-    for s in sources:
-        if posts_remaining <= 0:
-            break
-        try:
-            sent = await process_source(s, posts_remaining)
-            posts_remaining -= sent
-        except Exception as ex:
-            logging.exception("Error processing %s: %s", s.get("url"), ex)
+    # fetch all feeds concurrently, post sequentially (sends are rate limited by TG_LIMITER)
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    # fetch_stage handles per-feed errors itself
+    results = await asyncio.gather(*(fetch_stage(s, sem) for s in sources))
+
+    pending_inserts = []
+    try:
+        for s, entries in zip(sources, results):
+            if posts_remaining <= 0:
+                break
+            try:
+                sent, send_failed = await post_stage(s, entries, posts_remaining, domain_counts, pending_inserts)
+                posts_remaining -= sent
+                if send_failed:
+                    logging.warning("Telegram send failed — stopping posting for this run")
+                    break
+            except Exception as ex:
+                logging.exception("Error processing %s: %s", s.get("url"), ex)
+    finally:
+        # one commit for all posts of this run; runs on errors and on cancellation (SIGTERM)
+        await mark_sent_many(pending_inserts)
 
     logging.info("Job finished; posts remaining (this run): %s", posts_remaining)
 
 # ---------------- Runner ----------------
 async def start_loop():
+    global SESSION
     if not BOT_TOKEN or not CHAT_ID:
         logging.error("Missing TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID")
         raise SystemExit(1)
+    # docker stop sends SIGTERM to PID 1; cancel instead of dying so the finally blocks
+    # (pending sent_items flush, session/db close) still run
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
     await init_db()
-    # initial run immediately
-    await main_job()
-    # periodic loop
-    while True:
-        await asyncio.sleep(CHECK_INTERVAL_MINUTES * 60)
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=8, keepalive_timeout=75,
+                                     ttl_dns_cache=300)
+    SESSION = aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT})
+    try:
+        # initial run immediately
         await main_job()
+        # periodic loop
+        while True:
+            await asyncio.sleep(CHECK_INTERVAL_MINUTES * 60)
+            await main_job()
+    finally:
+        await SESSION.close()
+        await DB.close()
+        FEED_POOL.shutdown(wait=False)
 
 if __name__ == "__main__":
     try:
         asyncio.run(start_loop())
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass